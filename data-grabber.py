@@ -12,10 +12,14 @@ welshBaseRequestUrl = "http://agored.statscymru.llyw.cymru"
 outputfile = "out.csv"
 datasetID = "XXXX0000".lower()
 
+# Use one session for all the requests so that the TCP connection is reused
+# across the pages of a dataset rather than being set up again for each one.
+session = requests.Session()
+
 def get_next_link(url):
     print(f"Getting data from '{url}'")
     try:
-        r = requests.get(url)
+        r = session.get(url)
     except RuntimeError as error:
         print(error)
         print(f"Unable to make connection to petitions url '{url}'. Exiting...")
@@ -23,27 +27,13 @@ def get_next_link(url):
     list_data = r.json()
     return list_data
 
-def createdatafile(outfile, data):
-    with open(outfile, 'w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile, delimiter=',',
-                                quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        topRow = []
-        for key in data[0].keys():
-            topRow.append(key)
-        csvwriter.writerow(topRow)
-        csvfile.close()
-        return topRow
+def createdatafile(csvwriter, data):
+    topRow = list(data[0].keys())
+    csvwriter.writerow(topRow)
+    return topRow
 
-def writedata(outfile, toprow, data):
-         with open(outfile, 'a', newline='') as csvfile:
-            csvwriter = csv.writer(csvfile, delimiter=',',
-                                quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            for item in data:
-                row = []
-                for key in toprow:
-                    row.append(item[key])
-                csvwriter.writerow(row)
-            csvfile.close()
+def writedata(csvwriter, toprow, data):
+    csvwriter.writerows([item[key] for key in toprow] for item in data)
 
 def main(argv):
     global welshBaseRequestUrl, englistBaseRequestUrl
@@ -96,11 +86,16 @@ def main(argv):
         outputfile = f"{datasetID}.csv"
     
     opendata = get_next_link(initalRequestUrl)
-    toprow = createdatafile(outputfile, opendata['value'])
-    while 'odata.nextLink' in opendata:
-        writedata(outputfile, toprow, opendata['value'])
-        nextURL = opendata['odata.nextLink']
-        opendata = get_next_link(nextURL)
+    # Keep the file open for the whole download and thread one csv writer
+    # through the pages rather than reopening the file for each one.
+    with open(outputfile, 'w', newline='') as csvfile:
+        csvwriter = csv.writer(csvfile, delimiter=',',
+                                quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        toprow = createdatafile(csvwriter, opendata['value'])
+        while 'odata.nextLink' in opendata:
+            writedata(csvwriter, toprow, opendata['value'])
+            nextURL = opendata['odata.nextLink']
+            opendata = get_next_link(nextURL)
 
 if __name__ == "__main__":
    main(sys.argv[1:])
@@ -74,6 +74,7 @@ import requests
 import time
 import re
 import collections
+import functools
 
 # Parsing Libraries
 # We assume that StatsWales2 is trustworthy so do not currently defend against
@@ -95,6 +96,11 @@ http      = None
 # Longest interval to wait between HTTP Requests that time out.
 retry_max = 512
 
+# In-process memo of spider_uri_cache rows so that repeated fetch_uri() calls
+# for the same URI within a run skip the SQL lookup. Entries are only ever
+# added to the underlying table during a run so the memo cannot go stale.
+uri_cache_memo = {}
+
 
 
 ################################################################################
@@ -748,6 +754,38 @@ db_schema = [
         "	a.`lang` = 'cy-gb' AND\n"
         "	b.`dataset` IS NULL\n"
         ";\n",
+        #
+        #
+        #
+        # Covering index for looking up the metadata tags of a dataset in one
+        # language. The inspector tools fetch the "Title" / "Teitl" and update
+        # date tags for every dataset on a page so make that an index-only
+        # lookup instead of a walk over the table in PRIMARY KEY order.
+        # The index cannot be UNIQUE: see the notes above on
+        # odata_metadata_tag_duplicates.
+        "CREATE INDEX `odata_metadata_tag_by_dataset_lang_tag` ON `odata_metadata_tag` (\n"
+        "`dataset`,\n"
+        "`lang`,\n"
+        "`tag`,\n"
+        "`description`\n"
+        ");\n",
+        #
+        #
+        #
+        # Reverse indexes for the "which datasets use this dimension?"
+        # queries. The PRIMARY KEYs on these tables lead with dataset so
+        # filtering cubes by dimension (or dimension item) otherwise walks
+        # the whole table.
+        "CREATE INDEX `odata_dataset_dimension_by_dimension` ON `odata_dataset_dimension` (\n"
+        "`dimension`,\n"
+        "`dataset`\n"
+        ");\n",
+        #
+        "CREATE INDEX `odata_dataset_dimension_item_by_dimension` ON `odata_dataset_dimension_item` (\n"
+        "`dimension`,\n"
+        "`item`,\n"
+        "`dataset`\n"
+        ");\n",
         ]
 
 
@@ -862,6 +900,10 @@ def purge_database():
 
 
 # Adapted from https://gist.github.com/jeremyBanks/1083518/584008c38a363c45acb84e4067b5188bb36e20f4
+# The identifiers we quote are overwhelmingly the same small set of table and
+# column names so memoise the encode and scan work: repeat calls become a dict
+# lookup. The procedure is pure so this is safe.
+@functools.lru_cache(maxsize=2048)
 def sqlite3_quote_identifier(s, errors="strict"):
     encodable = s.encode("utf-8", errors).decode("utf-8")
 
@@ -889,6 +931,10 @@ class SkipRow(Exception):
 # Quotes all the identifiers supplied in table and columns.
 # Any remaining arguments should be generated with WHERE or similar procedures
 # as they will be joined with whitespace and included literally.
+# Memoised because the same few query shapes are generated over and over
+# again: columns must therefore be passed as a tuple, which all the callers
+# already do.
+@functools.lru_cache(maxsize=1024)
 def SELECT(table, columns, *args):
 
     table   = sqlite3_quote_identifier(table)
@@ -913,10 +959,10 @@ def SELECT(table, columns, *args):
 #   [(column_name, converter, state), ...]
 # Quotes all of the identifiers and generates unnamed, positional SQL
 # parameters for all of the columns.
-# Returns a procedure that takes a cursor and a dictionary and performs the
-# INSERT.
-# If we were using a database over a socket rather than in core then it would
-# be nice to refactor this to be able to use a batching interface.
+# Returns a procedure that takes a cursor and an iterable of dictionaries and
+# performs the INSERTs for the whole batch with a single executemany call.
+# This amortises the Python to SQLite bridging cost over all the rows in a
+# page rather than paying it per row.
 def INSERT(table, the_map):
 
     # Build the query string.
@@ -932,29 +978,37 @@ def INSERT(table, the_map):
         (column, converter, state) = spec
         return converter(state, dictionary)
 
-    # Perform the INSERT given the data in dictionary.
-    def closure(cursor, dictionary):
-        # INSERT the row unless one of the converters tells us otherwise.
+    # Perform the INSERTs given the data in dictionaries.
+    def closure(cursor, dictionaries):
+        # Prepare the bindings for every row up front and then INSERT the
+        # whole batch at once, skipping any row where one of the converters
+        # tells us otherwise.
         # We go to some lengths to ensure that every converter for every
-        # binding runs because some (for example autoincrements) have side
-        # effects and we want the side effects to have a chance to happen even
-        # if the row is not INSERTed.
-        bindings = []
-        failed   = 0
+        # binding runs, in row order, because some (for example
+        # autoincrements) have side effects and we want the side effects to
+        # have a chance to happen even if the row is not INSERTed.
+        rows = []
 
-        for x in the_map:
-            try:
-                bindings.append(bind(x, dictionary))
-            except SkipRow:
-                failed += 1
+        for dictionary in dictionaries:
+            bindings = []
+            failed   = 0
 
-        if (failed == 0):
+            for x in the_map:
+                try:
+                    bindings.append(bind(x, dictionary))
+                except SkipRow:
+                    failed += 1
+
+            if (failed == 0):
+                rows.append(bindings)
+
+        if rows:
             try:
-                cursor.execute(query, bindings)
+                cursor.executemany(query, rows)
             except Exception as e:
                 warn("INSERT: Error during query:\n")
                 warn("\t%s\n" % query)
-                warn("\t%s\n" % bindings)
+                warn("\t%d rows starting with %s\n" % (len(rows), rows[0]))
                 warn("\n")
                 raise e
 
@@ -990,31 +1044,34 @@ def CHECK_ROW(table, the_map, check_nulls = True):
         (column, converter, state) = spec
         return converter(state, dictionary)
 
-    # Perform the SELECT given the data in dictionary and check that the count
-    # is 1.
-    def closure(cursor, dictionary):
-        # SELECT the row unless one of the converters tells us otherwise.
-        # We go to some lengths to ensure that every converter for every
-        # binding runs because some (for example autoincrements) have side
-        # effects and we want the side effects to have a chance to happen even
-        # if the row is not INSERTed.
-        bindings = []
-        failed   = 0
-
-        for x in the_map:
-            try:
-                b = bind(x, dictionary)
-                bindings.append(b)  # =  condition
-                if (check_nulls):
-                    bindings.append(b)  # IS condition
-            except SkipRow:
-                failed +=1
-
-        if (failed == 0):
-            r = cursor.execute(query, bindings)
-            r = r.fetchone()
-            if (r[0] != 1):
-                raise AssertionError("CHECK_ROW: Expected to find a single row in the database but there were %d during %s with %s!" % (r[0], query, bindings))
+    # Perform the SELECT for each row given the data in dictionaries and check
+    # that each count is 1.
+    # The check needs the count for every individual row so, unlike INSERT,
+    # this cannot be batched into a single database operation.
+    def closure(cursor, dictionaries):
+        for dictionary in dictionaries:
+            # SELECT the row unless one of the converters tells us otherwise.
+            # We go to some lengths to ensure that every converter for every
+            # binding runs because some (for example autoincrements) have side
+            # effects and we want the side effects to have a chance to happen
+            # even if the row is not INSERTed.
+            bindings = []
+            failed   = 0
+
+            for x in the_map:
+                try:
+                    b = bind(x, dictionary)
+                    bindings.append(b)  # =  condition
+                    if (check_nulls):
+                        bindings.append(b)  # IS condition
+                except SkipRow:
+                    failed +=1
+
+            if (failed == 0):
+                r = cursor.execute(query, bindings)
+                r = r.fetchone()
+                if (r[0] != 1):
+                    raise AssertionError("CHECK_ROW: Expected to find a single row in the database but there were %d during %s with %s!" % (r[0], query, bindings))
 
     return closure
 
@@ -1024,7 +1081,7 @@ def CHECK_ROW(table, the_map, check_nulls = True):
 # used to ignore rows that cause known problems.
 def IGNORE_ROW(table, the_map):
 
-    def closure(cursor, dictionary):
+    def closure(cursor, dictionaries):
         pass
 
     return closure
@@ -1097,8 +1154,12 @@ def fetch_uri(base, path=None):
     pretty_uri = uri if (len(uri) <= 30) else "%s...%s" % (uri[:15], uri[-15:])
     warn("fetch_uri: %s" % pretty_uri)
 
-    # Check the cache.
-    local = check_uri_cache(uri)
+    # Check the cache, via the in-process memo first.
+    local = uri_cache_memo.get(uri)
+    if (local is None):
+        local = check_uri_cache(uri)
+        if (local is not None):
+            uri_cache_memo[uri] = local
 
     # Cache hit: just return it
     if (local is not None):
@@ -1167,7 +1228,8 @@ def fetch_uri(base, path=None):
 
     # Check the cache so that we return the same thing in cached and non-cached
     # situations.
-    local = check_uri_cache(uri, now)
+    local               = check_uri_cache(uri, now)
+    uri_cache_memo[uri] = local
 
     return local
 
@@ -1182,6 +1244,12 @@ def from_ugc(filename):
 #
 # Returns a two element tuple thus:
 #   (mime_type, dictionary)
+#
+# StatsWales2 only ever serves a handful of distinct content-type strings but
+# we parse one for every file we process, so memoise the result. Callers must
+# treat the returned tuple (including the dictionary) as read-only because it
+# is shared between calls.
+@functools.lru_cache(maxsize=None)
 def parse_content_type(header):
 
     components = header.split(";")
@@ -1289,10 +1357,10 @@ def load_json_pages(local_file, cursor, insert_procs):
         value = tree["value"]
         more  = tree.get("odata.nextLink", False)
 
-        # Insert the correct data from each value into each table.
+        # Insert the correct data from each value into each table, a whole
+        # page of values at a time.
         for p in insert_procs:
-            for v in value:
-                p(cursor, v)
+            p(cursor, value)
 
         # Carry on with the next page.
         if (more):
@@ -1327,8 +1395,8 @@ def load_dataset_collections():
                     ("lang",    identity, lang),
                     ]
 
-            QUERY ("dataset_collection",      collection_map)(c, {})
-            INSERT("dataset_collection_info", info_map)      (c, {})
+            QUERY ("dataset_collection",      collection_map)(c, ({},))
+            INSERT("dataset_collection_info", info_map)      (c, ({},))
 
     def load_from(base, lang):
 
@@ -1463,11 +1531,9 @@ def load_dataset_properties():
                     "ItemNotes"   : "item_notes",
                     }
 
-            recursive_dict = lambda: collections.defaultdict(recursive_dict)
-
-            measure      = collections.defaultdict(dict)            # Dictionary of column_prefixes to signatures.
-            dimensions   = collections.defaultdict(dict)            # Dictionary of dimension names to column_prefixes to signatures.
-            alternatives = collections.defaultdict(recursive_dict)  # Dictionary of dimension names to alternative_indexes to signatures.
+            measure      = collections.defaultdict(dict)  # Dictionary of column_prefixes to signatures.
+            dimensions   = collections.defaultdict(dict)  # Dictionary of dimension names to column_prefixes to signatures.
+            alternatives = {}                             # Dictionary of dimension names to alternative_indexes to signatures.
 
             # Group the properties into type signatures for Measure or Dimension data.
             for p in properties:
@@ -1497,9 +1563,10 @@ def load_dataset_properties():
                     dimension_property = name[1]
 
                     if (dimension_property[:-1] == "AltCode"):
-                        alternative_index                                                       = int(dimension_property[-1:])
-                        alternatives[dimension_name][alternative_index]["alternative_type"]     = type
-                        alternatives[dimension_name][alternative_index]["alternative_nullable"] = nullable
+                        alternative_index                   = int(dimension_property[-1:])
+                        alternative                         = alternatives.setdefault(dimension_name, {}).setdefault(alternative_index, {})
+                        alternative["alternative_type"]     = type
+                        alternative["alternative_nullable"] = nullable
                     else:
                         column_prefix                                           = key_to_column_prefix[dimension_property]
                         dimensions[dimension_name][column_prefix + "_type"]     = type
@@ -1534,7 +1601,7 @@ def load_dataset_properties():
             the_map  = [("dataset", identity, dataset)]
             the_map += [(k, identity, measure[k]) for k in sorted(measure)]
 
-            QUERY("dataset_property_measure", the_map)(c, {})
+            QUERY("dataset_property_measure", the_map)(c, ({},))
 
 
             for dimension, d in dimensions.items():
@@ -1545,7 +1612,7 @@ def load_dataset_properties():
                         ]
                 the_map += [(k, identity, d[k]) for k in sorted(d)]
 
-                QUERY("dataset_property_dimension", the_map)(c, {})
+                QUERY("dataset_property_dimension", the_map)(c, ({},))
 
 
             for dimension, alternatives in alternatives.items():
@@ -1558,15 +1625,19 @@ def load_dataset_properties():
                             ]
                     the_map += [(k, identity, a[k]) for k in sorted(a)]
 
-                    QUERY("dataset_property_dimension_alternative", the_map)(c, {})
+                    QUERY("dataset_property_dimension_alternative", the_map)(c, ({},))
 
 
     # Load the English and check the Welsh
-    load_from(fetch_uri(ebu, ("dataset", "$metadata")), "en-gb")
+    # Both passes read the same English $metadata document so fetch it once
+    # and reuse the cache entry.
+    metadata = fetch_uri(ebu, ("dataset", "$metadata"))
+
+    load_from(metadata, "en-gb")
     warn("load_dataset_properties: Loading missing dataset properties for en-gb.\n")
     load_from({"filename": "extra.dataset_property_dimension.xml", "content-type": "application/xml"}, "en-gb")
 
-    load_from(fetch_uri(ebu, ("dataset", "$metadata")), "cy-gb")
+    load_from(metadata, "cy-gb")
     warn("load_dataset_properties: Loading missing dataset properties for cy-gb.\n")
     load_from({"filename": "extra.dataset_property_dimension.xml", "content-type": "application/xml"}, "cy-gb")
 
@@ -2057,25 +2128,24 @@ def load_datasets(start_from = None):
 
     c = db.cursor()
 
-    # Download each cube that we expect OData for.
+    # Download each cube that we expect OData for and generate warnings for
+    # the cubes that don't have hrefs.
+    # One query gives us both so that dataset_collection is only walked once
+    # rather than once per case.
     q = c.execute(SELECT("dataset_collection", ("dataset", "href",),
-        "WHERE `href` IS NOT NULL AND ((NULL IS ?) OR (`dataset` >= ?)) ORDER BY `dataset`;"),
-        (start_from, start_from))
-
-    r = q.fetchone()
-    while (r):
-        load_dataset(r[0], r[1])
-        r = q.fetchone()
-
-    # Generate warnings for the cubes that don't have hrefs.
-    q = c.execute(SELECT("dataset_collection", ("dataset",),
-        "WHERE `href` IS NULL AND ((NULL IS ?) OR (`dataset` >= ?)) ORDER BY `dataset`;"),
+        "WHERE ((NULL IS ?) OR (`dataset` >= ?)) ORDER BY `dataset`;"),
         (start_from, start_from))
 
-    r = q.fetchone()
-    while (r):
-        warn("load_datasets: Ignoring %s\n" % r[0])
-        r = q.fetchone()
+    # Fetch the rows in batches rather than one at a time so that the cost of
+    # crossing into the sqlite3 library is amortised over each batch.
+    rows = q.fetchmany(256)
+    while (rows):
+        for (dataset, href) in rows:
+            if (href is None):
+                warn("load_datasets: Ignoring %s\n" % dataset)
+            else:
+                load_dataset(dataset, href)
+        rows = q.fetchmany(256)
 
 
 def load_all():
@@ -2094,7 +2164,10 @@ def initialise():
 
     # Initialise the database.
 
-    db = sqlite3.connect("statswales2.hypercube.sqlite")
+    # The load procedures execute the same INSERT, CHECK_ROW and cache-lookup
+    # statements over and over again so make the connection's statement cache
+    # big enough to hold every query shape we use and avoid re-preparing them.
+    db = sqlite3.connect("statswales2.hypercube.sqlite", cached_statements=256)
 
     # Autocommit is sqlite3.LEGACY_TRANSACTION_CONTROL until at least v3.12 and
     # the attribute is not available at all in v3.7
@@ -2112,6 +2185,19 @@ def initialise():
 
     db.execute("PRAGMA foreign_keys = ON;")
 
+    # Performance settings.
+    # WAL stops readers (e.g. inspectors pointed at the database during a
+    # load) blocking behind the writer and synchronous=NORMAL is durable
+    # enough for a database that can always be rebuilt from the URI cache.
+    # The temp store and mmap settings keep sort scratch space and page reads
+    # out of the syscall path and the page cache is sized (in KiB) to hold
+    # the hot tables during the big loads.
+    db.execute("PRAGMA journal_mode = WAL;")
+    db.execute("PRAGMA synchronous = NORMAL;")
+    db.execute("PRAGMA temp_store = MEMORY;")
+    db.execute("PRAGMA mmap_size = 268435456;")
+    db.execute("PRAGMA cache_size = -65536;")
+
     upgrade_database()
 
 